@@ -9,12 +9,14 @@ import sys
 import re
 import os
 import datetime
+import math
+import mmap
 
 # Dependencies
 # on the pi, these can be installed with:
 # $ sudo apt-get install python3-scipy
+# scipy is slow to import on the pi, so it is only imported once the arguments have been validated (see buildInterpolator)
 import numpy as np
-from scipy.interpolate import Rbf
 
 
 colonSeparatedNumbersPattern = re.compile('-?\\d+:-?\\d+')
@@ -24,6 +26,15 @@ def colonSeparatedNumbersArgType(arg_value):
         raise argparse.ArgumentTypeError
     return arg_value
 
+# the thin plate spline kernel adds a degree 1 polynomial, which needs at least 3 points to solve
+minimumRbfPoints = 3
+
+def neighborsArgType(arg_value):
+    neighbors = int(arg_value)
+    if neighbors < minimumRbfPoints:
+        raise argparse.ArgumentTypeError('must be at least {}'.format(minimumRbfPoints))
+    return neighbors
+
 parser = argparse.ArgumentParser(description='Process a bed probing log and generate a heightmap.csv')
 # Add the arguments
 
@@ -74,11 +85,23 @@ parser.add_argument('-M',
                        action='store',
                        help='The maximum number of points that can be sampled in the heightmap file. The optimal sample point spacing is determined from this value if --num-points is omitted. Optional, Defaults to 441.')
 
+parser.add_argument('-N',
+                       '--neighbors',
+                       metavar='NEIGHBORS',
+                       type=neighborsArgType,
+                       action='store',
+                       help='Build the bed model from only this many of the nearest probed points around each heightmap point. Reduces memory and time with very large probe logs, at some cost to model smoothness. Must be at least 3, but small values can fail on grid-like probe layouts where the nearest probed points all lie on one line; use a larger value if that happens. Optional, all probed points are used if this is omitted.')
+
 parser.add_argument('-dsf',
                        '--dsf-path-mode',
                        action='store_true',
                        help='Enable DSF path compatibility mode. Treats file paths as M98 would in RRF. The script assumes the working directory is the root of the virtual SD card.')
 
+parser.add_argument('-v',
+                       '--verbose',
+                       action='store_true',
+                       help='Print the generated heightmap to the console as well as writing it to the heightmap file.')
+
 # convert a raw path to its DSF equivalent path as required
 def dsfPath(rawPath, isDsfMode):
     dsfConvertedPath = rawPath
@@ -103,6 +126,21 @@ def selectMeshInterval(xMin, xMax, yMin, yMax, maxSamplePoints):
     # start with a minimum of 2 points per side
     u = v = x = y = 2
 
+    # jump ahead in closed form: the loop below takes every spacing wider than some threshold before any narrower one,
+    # so seed it with the inverse spacing t at which (xSide * t + 1) * (ySide * t + 1) == maxSamplePoints and only walk the last few steps
+    if xSideLength > 0 and ySideLength > 0 and maxSamplePoints > 4:
+        sideSum = xSideLength + ySideLength
+        sideProduct = xSideLength * ySideLength
+        t = (math.sqrt(sideSum * sideSum + 4 * sideProduct * (maxSamplePoints - 1)) - sideSum) / (2 * sideProduct)
+        seedU = max(2, math.ceil(xSideLength * t))
+        seedV = max(2, math.ceil(ySideLength * t))
+        # only use the seed if the loop would have passed through it, including its tiebreaker
+        if ((seedU * seedV) <= maxSamplePoints
+                and (seedU == 2 or (xSideLength / (seedU - 1)) > (ySideLength / seedV))
+                and (seedV == 2 or not (xSideLength / seedU) > (ySideLength / (seedV - 1)))):
+            u = seedU
+            v = seedV
+
     # add points to the side with the widest spacing until we exhaust the points available
     while (u * v) <= maxSamplePoints:
         x = u
@@ -132,45 +170,36 @@ maxSamplePoints = parsedArgs.max_points
 isDsfPathMode = parsedArgs.dsf_path_mode
 probeLogPath = dsfPath(parsedArgs.probe_log_file, isDsfPathMode)
 heightmapPath = dsfPath(parsedArgs.heightmap_file, isDsfPathMode)
+isVerbose = parsedArgs.verbose
+neighbors = parsedArgs.neighbors
 
 # Matches: Mesh Point: X20.485 Y-13 Z0.025
-probePointPattern = re.compile('Mesh Point: X(-?\\d*\\.?\\d*) Y(-?\\d*\\.?\\d*) Z(-?\\d*\\.?\\d*)')
-# read input file and extract probed coordinates from matching lines
-def parseProbedPoints() -> {}:
-    # open the bed sample file and read all lines
-    lines = []
-    with open(probeLogPath, 'r') as bedFile:
-        lines = bedFile.readlines()
-
-    probedPoints = {}
-
-    for line in lines:
-        match = probePointPattern.search(line)
-        if match != None:
-            captured = match.groups()
-            xyCoordinate = (float(captured[0]), float(captured[1]))
-            zOffset = float(captured[2])
-
-            # group points with identical X/Y coordinates so the Z values can be averaged in the next step
-            if xyCoordinate not in probedPoints:
-                probedPoints[xyCoordinate] = [];
-
-            probedPoints[xyCoordinate].append(zOffset)
-
-    return probedPoints
-
-# Average Z values and produce the 3-array x/y/z structure required for the RBF
-def averageZOffset(probedPoints):
-    x = []
-    y = []
-    z = []
-
-    for xyCoordinate, zOffsets in probedPoints.items():
-        x.append(xyCoordinate[0])
-        y.append(xyCoordinate[1])
-        z.append(sum(zOffsets) / len(zOffsets))
-    
-    return (x, y, z)
+# each number must contain at least one digit so malformed lines are skipped
+# fraction digits are only tried after a literal '.', so a run of digits can only be matched one way and a malformed line can't cause quadratic backtracking
+probePointPattern = re.compile(rb'Mesh Point: X(-?(?:\d+(?:\.\d*)?|\.\d+)) Y(-?(?:\d+(?:\.\d*)?|\.\d+)) Z(-?(?:\d+(?:\.\d*)?|\.\d+))')
+# read input file, extract probed coordinates from matching lines and average Z values
+# produces the (N, 2) x/y array and (N,) z array required for the RBF
+def parseProbedPoints():
+    # map the bed sample file into memory and scan its raw bytes in one go
+    with open(probeLogPath, 'rb') as bedFile:
+        # an empty file can't be mapped, it just has no probe points
+        if os.fstat(bedFile.fileno()).st_size == 0:
+            probedPoints = np.empty((0, 3), dtype=np.float64)
+        else:
+            with mmap.mmap(bedFile.fileno(), 0, access=mmap.ACCESS_READ) as bedLog:
+                # one row of x/y/z per matching line
+                probedPoints = np.array(probePointPattern.findall(bedLog), dtype=np.float64).reshape(-1, 3)
+
+    # group points with identical X/Y coordinates so the Z values can be averaged
+    xyCoordinates, groupIndex = np.unique(probedPoints[:, :2], axis=0, return_inverse=True)
+    groupIndex = groupIndex.ravel()
+    z = np.bincount(groupIndex, weights=probedPoints[:, 2]) / np.bincount(groupIndex)
+
+    # the thin plate spline kernel also fits a plane through the points, which needs points that are not all on one line
+    if len(xyCoordinates) < minimumRbfPoints or np.linalg.matrix_rank(np.column_stack([xyCoordinates, np.ones(len(xyCoordinates))])) < 3:
+        sys.exit('Found {} unique probe points in {}, at least {} that are not all on one line are required'.format(len(xyCoordinates), probeLogPath, minimumRbfPoints))
+
+    return (xyCoordinates, z)
 
 # Return a mesh grid of x/y values that RRF expects to have been probed in the heightmap
 def buildMeshPoints():
@@ -178,42 +207,70 @@ def buildMeshPoints():
     maxval =  1
     return np.meshgrid(np.linspace(xMin, xMax, xPoints), np.linspace(yMin, yMax, yPoints))
 
-# Use RBF and mesh grid to compute the Z values at all heightmap sample points
-def upsampleBedMesh(averagedPoints):
+# Use RBF to build a model of the bed surface from the averaged probe points
+# without --neighbors the linear solve happens once here and the returned interpolator can then be sampled at any number of mesh grids
+def buildInterpolator(averagedPoints):
     # Use Radial Basis Functions (RBF) to interpolate the bed surface from random sample points
     # To see how RBF compare to other techniques: https://stackoverflow.com/questions/37872171/how-can-i-perform-two-dimensional-interpolation-using-scipy
-    # Reference: https://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.Rbf.html
-    rbfInterpolator = Rbf(averagedPoints[0], averagedPoints[1], averagedPoints[2], smooth=0)
-    return rbfInterpolator(*buildMeshPoints())   # sample the interpolated surface for the final bed mesh
+    # Reference: https://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.RBFInterpolator.html
+    from scipy.interpolate import RBFInterpolator
+
+    probedXY, probedZ = averagedPoints
+    # with neighbors set, no solve happens here: each heightmap point gets a small local solve when it is sampled in upsampleBedMesh
+    return RBFInterpolator(probedXY, probedZ, smoothing=0.0, kernel='thin_plate_spline', neighbors=neighbors)
+
+# Use the RBF model and mesh grid to compute the Z values at all heightmap sample points
+def upsampleBedMesh(rbfInterpolator, meshPoints):
+    # sample the interpolated surface for the final bed mesh
+    # the thin plate spline kernel is not separable, so evaluate a few grid rows at a time to cap peak memory
+    # each chunk is sized so its (grid points x probed points) kernel matrix of float64 stays within about 256 kB
+    xx, yy = meshPoints
+    rowLength = xx.shape[1]
+    rowsPerChunk = max(1, (256 * 1024) // (rowLength * len(rbfInterpolator.y) * 8))
+    upsampledBedMesh = np.empty(xx.shape, dtype=np.float64)
+    for rowStart in range(0, xx.shape[0], rowsPerChunk):
+        rowEnd = rowStart + rowsPerChunk
+        chunkXY = np.column_stack([xx[rowStart:rowEnd].ravel(), yy[rowStart:rowEnd].ravel()])
+        upsampledBedMesh[rowStart:rowEnd] = rbfInterpolator(chunkXY).reshape(-1, rowLength)
+    return upsampledBedMesh
 
 # Write a RRF compatible heightmap.csv file
 def writeHeightmap(upsampledBedMesh):
     # this header line is necessary to convince RRF that the file is genuine
-    str_out = 'RepRapFirmware height map file v2 generated at '
-    str_out += datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
-    str_out += '\n'
+    header = 'RepRapFirmware height map file v2 generated at '
+    header += datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+    header += '\n'
     # this line also needs to be exactly as-is to pass the parser
-    str_out += 'xmin,xmax,ymin,ymax,radius,xspacing,yspacing,xnum,ynum\n'
+    header += 'xmin,xmax,ymin,ymax,radius,xspacing,yspacing,xnum,ynum\n'
     # numbers here seem to be rounded to 2 decimal places
     settingsLine = [xMin, xMax, yMin, yMax, -1.00, round((xMax - xMin) / (xPoints - 1), 2), round((yMax - yMin) / (yPoints - 1), 2), xPoints, yPoints]
-    str_out += ','.join(str(val) for val in settingsLine)
-    str_out += '\n'
+    header += ','.join(str(val) for val in settingsLine)
+    header += '\n'
 
     # write one line in the settings file for row of points
-    for row in upsampledBedMesh:
-        #note: these lines start with a space in the RRF code, which appears to be a bug, but leaving it out still works
-        # Z-values seem to be rounded to 3 decimal places
-        str_out += ', '.join(str(round(val, 3)) for val in row)
-        str_out += '\n'
-
-    print(str_out)
+    #note: these lines start with a space in the RRF code, which appears to be a bug, but leaving it out still works
+    # Z-values seem to be rounded to 3 decimal places, round the whole mesh once
+    # adding 0.0 turns any -0.0 into 0.0 so tiny negative values are not written as '-0.000'
+    roundedBedMesh = np.round(upsampledBedMesh, 3) + 0.0
+    if isVerbose:
+        sys.stdout.write(header)
+        np.savetxt(sys.stdout, roundedBedMesh, fmt='%.3f', delimiter=', ')
 
     # create the heightmap file & write contents
     with open(heightmapPath, 'w') as meshFile:
-        meshFile.write(str_out)
-    
+        meshFile.write(header)
+        np.savetxt(meshFile, roundedBedMesh, fmt='%.3f', delimiter=', ')
+
     # allow all users to read/write/execute the file, so DSF can have access
     os.chmod(heightmapPath, 0o777)
 
 # Preform processing of probe data to heightmap file
-writeHeightmap(upsampleBedMesh(averageZOffset(parseProbedPoints())))
+rbfInterpolator = buildInterpolator(parseProbedPoints())
+try:
+    upsampledBedMesh = upsampleBedMesh(rbfInterpolator, buildMeshPoints())
+except np.linalg.LinAlgError:
+    # with neighbors set the local solves happen while sampling, each one fails if its nearest probe points are all on one line
+    if neighbors is None:
+        raise
+    sys.exit('The bed model could not be sampled with --neighbors {}, the nearest probe points around some heightmap points are all on one line. Use a larger --neighbors value'.format(neighbors))
+writeHeightmap(upsampledBedMesh)